@@ -1,11 +1,15 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import re
 import sqlite3
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 from datetime import datetime
-import json
+from concurrent.futures import ThreadPoolExecutor
+from pandas.io.json import ujson_loads
 import logging
 
 def setup_logging():
@@ -16,6 +20,41 @@ def setup_logging():
     )
 logger = logging.getLogger(__name__)
 
+def read_table(conn, table):
+    """
+    Read an entire SQLite3 table into a DataFrame straight from the cursor
+
+    Parameters:
+        conn (Connection): open SQLite3 connection
+        table (str): name of the table to read
+
+    Returns:
+        df (DataFrame): contents of the table
+    """
+    cursor = conn.execute(f"SELECT * FROM {table}")
+    columns = [desc[0] for desc in cursor.description]
+    return(pd.DataFrame.from_records(cursor.fetchall(), columns=columns))
+
+
+def read_tables(db_path, tables):
+    """
+    Read several SQLite3 tables concurrently, each thread using its own connection
+
+    Parameters:
+        db_path (str): path to the SQLite3 database
+        tables (list): names of the tables to read
+
+    Returns:
+        dfs (list): DataFrames in the same order as `tables`
+    """
+    def read(table):
+        with sqlite3.connect(db_path) as conn:
+            return(read_table(conn, table))
+
+    with ThreadPoolExecutor(max_workers=len(tables)) as executor:
+        return(list(executor.map(read, tables)))
+
+
 def cleanse_student_table(df):
     """
     Cleanse the `cademycode_students` table according to the discoveries made in the writeup
@@ -28,41 +67,60 @@ def cleanse_student_table(df):
         missing_data (DataFrame): incomplete data that was removed for later inspection
     
     """
-    df['age'] = (datetime.now() - pd.to_datetime(df['dob'])).astype('<m8[Y]')
-    df['age_group'] = np.int64((df['age']/10))*10
-
-    def parse_contact_info(contact_info):
+    dob = pd.to_datetime(df['dob']).to_numpy('datetime64[D]')
+    today = np.datetime64(datetime.now().date(), 'D')
+    birth_year = dob.astype('datetime64[Y]')
+    this_year = today.astype('datetime64[Y]')
+    # Compare (month, day) so leap years don't shift the birthday by a day
+    birth_month = dob.astype('datetime64[M]')
+    this_month = today.astype('datetime64[M]')
+    m_dob, d_dob = birth_month - birth_year, dob - birth_month
+    m_today, d_today = this_month - this_year, today - this_month
+    # Subtract a year if the birthday hasn't occurred yet this year
+    pre_birthday = (m_dob > m_today) | ((m_dob == m_today) & (d_dob > d_today))
+    age = (this_year - birth_year).astype(np.int64) - pre_birthday
+    df['age'] = age
+    df['age_group'] = (age // 10) * 10
+
+    # Write the known contact fields straight into preallocated columns
+    mailing_address = np.empty(len(df), dtype=object)
+    email = np.empty(len(df), dtype=object)
+    loads = ujson_loads
+    for i, contact_info in enumerate(df['contact_info'].to_numpy()):
+        # Missing values stay null without going through the parser
+        if not isinstance(contact_info, str):
+            continue
         try:
-            # Convert string to dictionary using json.loads
-            contact_dict = json.loads(contact_info)
-            return pd.Series(contact_dict)
-        except json.JSONDecodeError:
-            return pd.Series({})
-    
-    explode_contact = df['contact_info'].apply(parse_contact_info)
-    df = pd.concat([df.drop('contact_info', axis=1).reset_index(drop=True), explode_contact], axis=1)
-
-    split_address = df.mailing_address.str.split(',', expand=True)
+            # Convert string to dictionary using pandas' bundled ujson parser
+            contact_dict = loads(contact_info)
+        except ValueError:
+            continue
+        mailing_address[i] = contact_dict.get('mailing_address')
+        email[i] = contact_dict.get('email')
+
+    df = df.drop('contact_info', axis=1)
+    df['mailing_address'] = mailing_address
+    df['email'] = email
+
+    address_pattern = re.compile(r'^([^,]*),([^,]*),([^,]*),([^,]*)$')
+    split_address = df['mailing_address'].str.extract(address_pattern)
     split_address.columns = ['street', 'city', 'state', 'zip_code']
     df = pd.concat([df.drop('mailing_address', axis=1), split_address], axis=1)
 
-    df['job_id'] = df['job_id'].astype(float)
-    df['num_course_taken'] = df['num_course_taken'].astype(float)
-    df['time_spent_hrs'] = df['time_spent_hrs'].astype(float)
-    df['current_career_path_id'] = df['current_career_path_id'].astype(float)
-    df['age'] = df['age'].astype(int)
-
-    missing_data = pd.DataFrame()
-    missing_course_taken = df[df[['num_course_taken']].isnull().any(axis=1)]
-    missing_data = pd.concat([missing_data, missing_course_taken])
-    df = df.dropna(subset=['num_course_taken'])
+    df = df.astype({
+        'job_id': 'float64',
+        'num_course_taken': 'float64',
+        'time_spent_hrs': 'float64',
+        'current_career_path_id': 'float64',
+        'age': 'int64'
+    })
 
-    missing_job_id = df[df[['job_id']].isnull().any(axis=1)]
-    missing_data = pd.concat([missing_data, missing_job_id])
-    df = df.dropna(subset=['job_id'])
+    # Rows missing either num_course_taken or job_id are set aside as incomplete
+    null_mask = np.isnan(df[['num_course_taken', 'job_id']].to_numpy()).any(axis=1)
+    missing_data = df[null_mask]
+    df = df[~null_mask]
 
-    df['current_career_path_id'] = np.where(df['current_career_path_id'].isnull(), 0, df['current_career_path_id'])
-    df['time_spent_hrs'] = np.where(df['time_spent_hrs'].isnull(), 0, df['time_spent_hrs'])
+    df = df.fillna({'current_career_path_id': 0, 'time_spent_hrs': 0})
 
     return(df, missing_data)
 
@@ -78,11 +136,10 @@ def cleanse_career_path(df):
         df (DataFrame): cleaned version of the input table
 
     """
-    not_applicable = {'career_path_id': 0, 
-                      'career_path_name': 'not applicable',
-                      'hours_to_complete': 0}
-    df.loc[len(df)] = not_applicable
-    return(df)
+    not_applicable = pd.DataFrame({'career_path_id': [0],
+                                   'career_path_name': ['not applicable'],
+                                   'hours_to_complete': [0]}).astype(df.dtypes.to_dict())
+    return(pd.concat([df, not_applicable], ignore_index=True))
 
 
 def cleanse_student_jobs(df):
@@ -109,8 +166,7 @@ def test_nulls(df):
     Returns:
         None
     """
-    df_missing = df[df.isnull().any(axis=1)]
-    count_missing = len(df_missing)
+    count_missing = int(df.isnull().to_numpy().any(axis=1).sum())
 
     try:
         assert count_missing == 0, "There are " + str(count_missing) + " nulls in the table."
@@ -133,15 +189,10 @@ def test_schema(local_df, db_df):
     Returns:
         None
     """
-    errors = 0
-    for col in db_df:
-        try:
-            if local_df[col].dtypes != db_df[col].dtypes:
-                errors += 1
-        except NameError as ne:
-            logger.exception(ne)
-            raise ne
-    
+    # Compare every column's dtype at once, columns missing locally count as mismatches
+    local_dtypes = local_df.dtypes.reindex(db_df.columns).astype(str).to_numpy()
+    errors = int((local_dtypes != db_df.dtypes.astype(str).to_numpy()).sum())
+
     if errors > 0:
         logger.exception(str(errors) + " column(s) dtypes aren't the same")
     assert errors == 0, str(errors) + " column(s) dtypes aren't the same"
@@ -179,9 +230,8 @@ def test_for_path_id(students, career_paths):
     Returns:
         None
     """
-    student_table = students.current_career_path_id.unique()
-    is_subset = np.isin(student_table, career_paths.career_path_id.unique())
-    missing_id = student_table[~is_subset]
+    student_table = students.current_career_path_id.drop_duplicates()
+    missing_id = student_table[~student_table.isin(career_paths.career_path_id)]
 
     try:
         assert len(missing_id) == 0, "Missing career_path_id(s): " + str(list(missing_id)) + " in 'courses' table"
@@ -203,9 +253,8 @@ def test_for_job_id(students, student_jobs):
     Returns:
         None
     """
-    student_table = students.job_id.unique()
-    is_subset = np.isin(student_table, student_jobs.job_id.unique())
-    missing_id = student_table[~is_subset]
+    student_table = students.job_id.drop_duplicates()
+    missing_id = student_table[~student_table.isin(student_jobs.job_id)]
 
     try:
         assert len(missing_id) == 0, "Missing job_id(s): " + str(list(missing_id)) + " in 'student_jobs' table"
@@ -233,31 +282,37 @@ def main():
 
     # Connect to the dev database and read in the three tables
     try:
-        with sqlite3.connect('cademycode.db') as conn:
-            students = pd.read_sql_query("SELECT * FROM cademycode_students", conn)
-            career_paths = pd.read_sql_query("SELECT * FROM cademycode_courses", conn)
-            student_jobs = pd.read_sql_query("SELECT * FROM cademycode_student_jobs", conn)
+        students, career_paths, student_jobs = read_tables(
+            'cademycode.db',
+            ['cademycode_students', 'cademycode_courses', 'cademycode_student_jobs']
+        )
 
         # Get the current production tables, if they exist
         try:
-            with sqlite3.connect('./prod/cademycode_cleansed.db') as conn:
-                clean_db = pd.read_sql_query("SELECT * FROM cademycode_aggregated", conn)
-                missing_db = pd.read_sql_query("SELECT * FROM incomplete_data", conn)
+            clean_db, missing_db = read_tables(
+                './prod/cademycode_cleansed.db',
+                ['cademycode_aggregated', 'incomplete_data']
+            )
 
             # Filter for students that don't exist in the cleansed database
-            new_students = students[~np.isin(students.uuid.unique(), clean_db.uuid.unique())]
+            new_students = students[~students['uuid'].isin(clean_db['uuid'])]
         except Exception as e:
             logger.exception(f"Error accessing prod database: {e}")
             new_students = students
             clean_db = []
 
-        # Run the cleanse_student_table() function on the new students only
-        clean_new_students, missing_data = cleanse_student_table(new_students)
+        # Clean the smaller tables in the background while cleanse_student_table() runs on the new students only
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            clean_career_paths_future = executor.submit(cleanse_career_path, career_paths)
+            clean_student_jobs_future = executor.submit(cleanse_student_jobs, student_jobs)
+            clean_new_students, missing_data = cleanse_student_table(new_students)
+        clean_career_paths = clean_career_paths_future.result()
+        clean_student_jobs = clean_student_jobs_future.result()
 
         
         try:
             # filter for incomplete rows that don't exist in the missing data table
-            new_missing_data = missing_data[~np.isin(missing_data.uuid.unique(), missing_db.uuid.unique())]
+            new_missing_data = missing_data[~missing_data['uuid'].isin(missing_db['uuid'])]
         except Exception as e:
             logger.exception(f"Error comparing missing data: {e}")
             new_missing_data = missing_data
@@ -265,14 +320,11 @@ def main():
         # Upsert new incomplete data if there are any
         if len(new_missing_data) > 0:
             with sqlite3.connect('./dev/cademycode_cleansed.db') as sqlite_connection:
-                missing_data.to_sql('incomplete_data', sqlite_connection, if_exists='append', index=False)
+                new_missing_data.to_sql('incomplete_data', sqlite_connection, if_exists='append', index=False,
+                                        method='multi', chunksize=1000)
             
         # Proceed only if there is new student data
         if len(clean_new_students) > 0:
-             # Clean the rest of the tables
-            clean_career_paths = cleanse_career_path(career_paths)
-            clean_student_jobs = cleanse_student_jobs(student_jobs)
-
             ##### UNIT TESTING BEFORE JOINING #####
             # Ensure that all required join keys are present
             test_for_job_id(clean_new_students, clean_student_jobs)
@@ -282,6 +334,12 @@ def main():
             clean_new_students['job_id'] = clean_new_students['job_id'].astype(int)
             clean_new_students['current_career_path_id'] = clean_new_students['current_career_path_id'].astype(int)
 
+            # Give both sides of each join a shared categorical dtype so the merges join on the codes
+            path_dtype = pd.CategoricalDtype(clean_career_paths['career_path_id'].unique())
+            job_dtype = pd.CategoricalDtype(clean_student_jobs['job_id'].unique())
+            clean_new_students = clean_new_students.astype({'current_career_path_id': path_dtype, 'job_id': job_dtype})
+            clean_career_paths = clean_career_paths.astype({'career_path_id': path_dtype})
+            clean_student_jobs = clean_student_jobs.astype({'job_id': job_dtype})
 
             df_clean = clean_new_students.merge(
                 clean_career_paths,
@@ -296,6 +354,9 @@ def main():
                 how='left'
             )
 
+            # Restore the integer join keys so the schema matches the database table
+            df_clean = df_clean.astype({'current_career_path_id': int, 'career_path_id': int, 'job_id': int})
+
             ##### UNIT TESTING #####
             # Ensure correct schema and complete data before upserting to database
             if len(clean_db) > 0:
@@ -306,11 +367,12 @@ def main():
 
             # Upsert new cleaned data to cademycode_cleansed.db
             with sqlite3.connect('./dev/cademycode_cleansed.db') as sqlite_connection:
-                df_clean.to_sql('cademycode_aggregated', sqlite_connection, if_exists='append', index=False)
-                clean_db = pd.read_sql_query("SELECT * FROM cademycode_aggregated", sqlite_connection)
-            
+                df_clean.to_sql('cademycode_aggregated', sqlite_connection, if_exists='append', index=False,
+                                method='multi', chunksize=1000)
+                clean_db = read_table(sqlite_connection, 'cademycode_aggregated')
+
             # Write new cleaned data to a csv file
-            clean_db.to_csv('./dev/cademycode_cleansed.csv')
+            pa_csv.write_csv(pa.Table.from_pandas(clean_db, preserve_index=False), './dev/cademycode_cleansed.csv')
 
             # create new automatic changelog entry
             new_lines = [